@@ -1,27 +1,364 @@
+import io
 import os
+import re
+import shutil
+import hashlib
+import tempfile
+import uuid
+import contextlib
+import collections
 import logging
+from pathlib import Path
+from urllib.parse import urlsplit
+import orjson
 from telegram import Update
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 from telegram.ext import Application, ContextTypes
+from telegram.request import HTTPXRequest
 from yt_dlp import YoutubeDL
+from cachetools import TTLCache
 import asyncio
-from flask import Flask, request
-from hypercorn.asyncio import serve
-from hypercorn.config import Config
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-# Set up logging
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Set up logging, unless the hosting server has already configured it
+if not logging.getLogger().handlers:
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Telegram bot token (set your bot API key here)
 BOT_API_KEY = os.getenv("BOT_API_KEY")
 
-# Initialize Flask app
-app = Flask(__name__)
+# Public base URL Telegram posts updates to, and the port to listen on
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+PORT = int(os.getenv("PORT", "8080"))
 
-# Initialize the Telegram bot application
-bot_app = Application.builder().token(BOT_API_KEY).build()
+# Local Bot API server (telegram-bot-api), if any. It raises the upload limit and
+# receives files by path, so they are not read into memory; it must see the download directory.
+BOT_API_URL = os.getenv("BOT_API_URL")
+
+class OrjsonHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses with orjson"""
+
+    @staticmethod
+    def parse_json_payload(payload):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError as exc:
+            raise TelegramError("Invalid server response") from exc
+
+def build_application():
+    """Build the Telegram bot application, whose handlers may run concurrently"""
+    # A larger HTTP/2 connection pool keeps long uploads from starving other requests
+    bot_request = OrjsonHTTPXRequest(connection_pool_size=64, read_timeout=600, write_timeout=600, http_version="2")
+    builder = Application.builder().token(BOT_API_KEY).request(bot_request).concurrent_updates(True)
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot").local_mode(True)
+    return builder.build()
+
+# Largest file the Bot API accepts in a single upload:
+# 50 MB through api.telegram.org, 2000 MB through a local Bot API server
+TELEGRAM_FILE_LIMIT = (2000 if BOT_API_URL else 50) * 1024 * 1024
+
+# Resolutions offered to the user, highest first. Each video format counts towards
+# the nearest one at or below its shorter side, and the best format of each is offered.
+BUTTON_HEIGHTS = (2160, 1440, 1080, 720, 480, 360, 240, 144)
+
+# Downloads allowed to run at once, bounding disk, memory and bandwidth use
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))
+_DL_SEM = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+# Downloads a single playlist may run at once, leaving slots for other users
+PLAYLIST_CONCURRENCY = max(1, MAX_CONCURRENT_DOWNLOADS // 2)
+
+# Thread pool for blocking yt-dlp calls, so the event loop keeps serving updates
+_YDL_POOL = ThreadPoolExecutor(max_workers=8)
+
+# Options for metadata-only extraction
+YDL_INFO_OPTS = {"quiet": True, "skip_download": True, "no_warnings": True, "noplaylist": True}
+
+# Free space RAM-backed /dev/shm must have when a download starts for it to be used
+SHM_MIN_FREE = 4 * 1024 * 1024 * 1024
+
+def _work_dir():
+    """Pick the directory the next download is written to before being uploaded.
+
+    YTDL_WORK_DIR is used when set. Otherwise /dev/shm is used while it has SHM_MIN_FREE
+    bytes free, checked per download since several downloads may be filling it at once,
+    and the system temp directory is the fallback.
+    """
+    work_dir = os.getenv("YTDL_WORK_DIR")
+    if not work_dir:
+        work_dir = "/dev/shm/ytdl"
+        if not os.path.isdir("/dev/shm") or shutil.disk_usage("/dev/shm").free < SHM_MIN_FREE:
+            work_dir = os.path.join(tempfile.gettempdir(), "ytdl")
+    os.makedirs(work_dir, exist_ok=True)
+    return work_dir
+
+# Options used when downloading the video/audio
+YDL_DOWNLOAD_OPTS = {
+    # Prefer natively MP4 streams so merging is a stream copy, not a re-encode
+    'format': 'bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]/b',
+    'merge_output_format': 'mp4',
+    'quiet': True,
+    # Fetch DASH/HLS fragments in parallel and plain HTTP downloads in resumable chunks
+    'concurrent_fragment_downloads': 16,
+    'http_chunk_size': 10 * 1024 * 1024,
+    'retries': 10,
+    'fragment_retries': 10,
+}
+
+# Download progressive HTTP formats over 16 parallel connections when aria2c is installed
+if shutil.which("aria2c"):
+    YDL_DOWNLOAD_OPTS.update({
+        'external_downloader': {'http': 'aria2c'},
+        'external_downloader_args': {
+            'aria2c': ['-x', '16', '-s', '16', '-k', '1M', '--file-allocation=none', '--summary-interval=0'],
+        },
+    })
+
+# One reusable extractor per pool thread, so setup is paid once and no lock is needed
+_ydl_local = threading.local()
+
+def _info_extractor():
+    """Return this thread's cached metadata-only YoutubeDL instance"""
+    ydl = getattr(_ydl_local, "ydl", None)
+    if ydl is None:
+        ydl = _ydl_local.ydl = YoutubeDL(YDL_INFO_OPTS)
+    return ydl
+
+# Extracted video info, keyed by video ID and kept for 30 minutes
+_INFO_CACHE = TTLCache(maxsize=1024, ttl=1800)
+_INFO_CACHE_LOCK = threading.Lock()
+
+# URLs waiting for the user to pick a format, keyed by the short key in the callback data.
+# Only touched from the event loop, so no lock is needed.
+_PENDING_CHOICES = TTLCache(maxsize=4096, ttl=1800)
+
+_YOUTUBE_HOSTS = ("youtube.com", "youtu.be", "youtube-nocookie.com")
+_VIDEO_ID_RE = re.compile(r"(?:[?&]v=|/shorts/|/embed/|/live/|youtu\.be/)([0-9A-Za-z_-]{11})")
+
+def _cache_key(url):
+    """Return the video ID of a YouTube URL, or the URL itself for other sites or URLs without one"""
+    host = urlsplit(url if "//" in url else "//" + url).hostname or ""
+    if host not in _YOUTUBE_HOSTS and not host.endswith(tuple("." + h for h in _YOUTUBE_HOSTS)):
+        return url
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else url
+
+def _extract_info_sync(url):
+    """Blocking yt-dlp metadata extraction, served from the cache when possible"""
+    key = _cache_key(url)
+    with _INFO_CACHE_LOCK:
+        info = _INFO_CACHE.get(key)
+    if info is None:
+        info = _info_extractor().extract_info(url, download=False)
+        with _INFO_CACHE_LOCK:
+            _INFO_CACHE[key] = info
+    return info
+
+async def extract_info(url):
+    """Run yt-dlp extraction in the thread pool"""
+    return await asyncio.get_running_loop().run_in_executor(_YDL_POOL, _extract_info_sync, url)
+
+def _estimate_size(f, duration):
+    """Best guess of a format's size in bytes, 0 when unknown"""
+    size = f.get("filesize") or f.get("filesize_approx")
+    if size:
+        return size
+    if f.get("tbr") and duration:
+        # tbr is in KBit/s
+        return int(f["tbr"] * duration * 1024 / 8)
+    return 0
+
+def fetch_formats(info):
+    """Return (format_id, height, ext) for the best format of each offered resolution, plus the best audio"""
+    best_by_height = {}
+    best_audio = None
+    duration = info.get("duration")
+
+    def resolution(f):
+        # The shorter side, so vertical and widescreen videos compare like landscape ones
+        return min(f.get("width") or f["height"], f["height"])
+
+    def rank(f):
+        # Telegram plays H.264 in MP4 inline and it merges without re-encoding,
+        # so it wins over higher-bitrate VP9/AV1 formats of the same resolution
+        h264_mp4 = f.get("ext") == "mp4" and (f.get("vcodec") or "").startswith("avc1")
+        return h264_mp4, resolution(f), f.get("tbr") or 0
+
+    for f in info.get("formats") or []:
+        if _estimate_size(f, duration) > TELEGRAM_FILE_LIMIT:
+            continue
+        tbr = f.get("tbr") or 0
+        if f.get("height") and f.get("vcodec") != "none":
+            height = next((h for h in BUTTON_HEIGHTS if h <= resolution(f)), BUTTON_HEIGHTS[-1])
+            if height not in best_by_height or rank(f) > rank(best_by_height[height]):
+                best_by_height[height] = f
+        elif f.get("acodec") not in (None, "none"):
+            if best_audio is None or tbr > (best_audio.get("tbr") or 0):
+                best_audio = f
+
+    formats = [
+        (best_by_height[height]["format_id"], height, best_by_height[height]["ext"])
+        for height in BUTTON_HEIGHTS
+        if height in best_by_height
+    ]
+    if best_audio:
+        formats.append((best_audio["format_id"], "Audio", best_audio["ext"]))
+    return formats
+
+def _download_sync(info, format_spec=None):
+    """Blocking download of already extracted info, returns the output file path"""
+    ydl_opts = dict(YDL_DOWNLOAD_OPTS)
+    if format_spec:
+        ydl_opts['format'] = format_spec
+    # One file per (video ID, format spec), the same key shared_download uses, so
+    # downloads with different specs never write or delete each other's file
+    spec_tag = hashlib.sha1(repr(format_spec).encode()).hexdigest()[:8]
+    ydl_opts['outtmpl'] = os.path.join(_work_dir(), f"%(id)s.{spec_tag}.%(ext)s")
+    # The cached info was already processed at extraction time and still holds the
+    # formats picked then; strip them as yt-dlp does for --load-info-json. This also
+    # builds a new dict, so the shared cached info is never mutated.
+    info = YoutubeDL.sanitize_info(dict(info), remove_private_keys=True)
+    with YoutubeDL(ydl_opts) as ydl:
+        info = ydl.process_ie_result(info, download=True)
+    return info["requested_downloads"][0]["filepath"]
+
+async def download(info, format_spec=None):
+    """Run the yt-dlp download in the thread pool, at most MAX_CONCURRENT_DOWNLOADS at a time"""
+    async with _DL_SEM:
+        return await asyncio.get_running_loop().run_in_executor(_YDL_POOL, _download_sync, info, format_spec)
+
+# In-flight downloads shared by identical requests, keyed by (video ID, format),
+# and the number of requests currently using each of them
+_INFLIGHT = {}
+_INFLIGHT_USERS = collections.Counter()
+
+def _remove_download(task):
+    """Delete the file produced by a finished download task"""
+    if not task.cancelled() and task.exception() is None:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(task.result())
+
+@contextlib.asynccontextmanager
+async def shared_download(info, format_spec=None):
+    """Download info and yield the file path, sharing one download between identical requests.
+
+    The file is deleted once the last request using it leaves the context.
+    """
+    key = (info["id"], format_spec)
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = _INFLIGHT[key] = asyncio.create_task(download(info, format_spec))
+    _INFLIGHT_USERS[key] += 1
+    try:
+        # Shielded so a cancelled request does not abort the download for the others
+        yield await asyncio.shield(task)
+    finally:
+        _INFLIGHT_USERS[key] -= 1
+        if not _INFLIGHT_USERS[key]:
+            del _INFLIGHT_USERS[key]
+            del _INFLIGHT[key]
+            if task.done():
+                _remove_download(task)
+            else:
+                task.add_done_callback(_remove_download)
+
+class FileWindow(io.RawIOBase):
+    """Read-only view of a byte range of a file, used to upload parts without writing part files.
+
+    python-telegram-bot 20.3 reads file objects whole before sending them, so each part
+    is still held in memory during its upload (up to TELEGRAM_FILE_LIMIT bytes).
+    """
+
+    def __init__(self, path, start, length):
+        super().__init__()
+        self._file = open(path, "rb")
+        self._file.seek(start)
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        read = self._file.readinto(memoryview(buffer)[:size])
+        self._remaining -= read
+        return read
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+async def send_file(message, filename, size, audio=False):
+    """Send a downloaded video, or audio file if audio is set, in parts if it exceeds Telegram's upload limit"""
+    if size <= TELEGRAM_FILE_LIMIT:
+        reply = message.reply_audio if audio else message.reply_video
+        reply_kwargs = {} if audio else {"supports_streaming": True}
+        if BOT_API_URL:
+            # In local mode only the path is sent, the server reads the file itself
+            await reply(Path(filename), read_timeout=None, write_timeout=None, **reply_kwargs)
+            return
+
+        # Otherwise the file is read into memory; python-telegram-bot does not close it
+        with open(filename, "rb") as media:
+            await reply(media, read_timeout=None, write_timeout=None, **reply_kwargs)
+        return
+
+    name = Path(filename).name
+    for number, start in enumerate(range(0, size, TELEGRAM_FILE_LIMIT), 1):
+        with FileWindow(filename, start, min(TELEGRAM_FILE_LIMIT, size - start)) as part:
+            await message.reply_document(
+                document=part, filename=f"{name}.part{number}", read_timeout=None, write_timeout=None
+            )
+
+async def send_playlist(message, info):
+    """Download and send all playlist entries concurrently"""
+    semaphore = asyncio.Semaphore(PLAYLIST_CONCURRENCY)
+
+    async def _download_one(entry):
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                # Only the download counts against the playlist's slots, not the upload
+                async with semaphore:
+                    filename = await stack.enter_async_context(shared_download(entry))
+                await send_file(message, filename, os.stat(filename).st_size)
+        except Exception as e:
+            logger.error("Error downloading playlist entry %s: %s", entry.get("id"), e)
+            await message.reply_text(f"Error downloading {entry.get('title', entry['id'])}: {str(e)}")
+
+    await asyncio.gather(*(_download_one(entry) for entry in info.get("entries") or [] if entry))
+
+async def download_job(message, url, format_id):
+    """Background job that downloads the chosen format and sends it as a reply to message"""
+    try:
+        # Usually served from the info cache; re-extracted once it has expired,
+        # so the download never uses stale signed stream URLs
+        info_dict = await extract_info(url)
+
+        # Audio-only formats are downloaded as they are, video formats get the best audio merged in
+        chosen = next((f for f in info_dict.get("formats") or [] if f["format_id"] == format_id), {})
+        audio = chosen.get("vcodec") == "none"
+        format_spec = format_id if audio else f"{format_id}+ba[ext=m4a]/{format_id}+ba/{format_id}"
+
+        async with shared_download(info_dict, format_spec) as filename:
+            # Check if the file exists, then send it to the user
+            try:
+                size = os.stat(filename).st_size
+            except FileNotFoundError:
+                await message.reply_text("Sorry, there was an issue processing the video.")
+            else:
+                await message.reply_text("Sending your file...")
+                await send_file(message, filename, size, audio=audio)
+
+    except Exception as e:
+        logger.error("Error downloading %s: %s", url, e)
+        await message.reply_text(f"Error: {str(e)}")
 
 # Function to start the bot
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -43,67 +380,73 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     url = update.message.text
     await update.message.reply_text(f"Processing the URL: {url}...")
 
-    # Use yt-dlp to download the video/audio
-    ydl_opts = {
-        'format': 'bestvideo+bestaudio/best',
-        'outtmpl': './downloads/%(id)s.%(ext)s',
-        'postprocessors': [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': 'mp4',  # Change this if needed
-        }],
-        'quiet': True,
-    }
-
     try:
-        with YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(url, download=False)
-            video_url = info_dict.get("url", None)
-            filename = f"./downloads/{info_dict['id']}.mp4"
+        info_dict = await extract_info(url)
+        if info_dict.get("_type") == "playlist":
+            await update.message.reply_text(f"Downloading {len(info_dict.get('entries') or [])} videos...")
+            context.application.create_task(send_playlist(update.message, info_dict), update=update)
+            return
 
-            # Check if the file exists, then send it to the user
-            if os.path.exists(filename):
-                await update.message.reply_text("Sending your video...")
-                await update.message.reply_video(video=open(filename, 'rb'))
-                os.remove(filename)
-            else:
-                await update.message.reply_text("Sorry, there was an issue processing the video.")
+        # Let the user pick one of the available formats. Callback data is limited
+        # to 64 bytes, so the URL is kept under a short key; the download then gets
+        # the extracted info back from the info cache.
+        key = uuid.uuid4().hex[:8]
+        _PENDING_CHOICES[key] = url
+        buttons = [
+            [InlineKeyboardButton(
+                f"{height}p - {ext}" if height != "Audio" else f"Audio - {ext}",
+                callback_data=f"{key}|{format_id}",
+            )]
+            for format_id, height, ext in fetch_formats(info_dict)
+        ]
+        if not buttons:
+            _PENDING_CHOICES.pop(key, None)
+            await update.message.reply_text("Sorry, no format of this video is small enough to send.")
+            return
+        await update.message.reply_text("Choose a format:", reply_markup=InlineKeyboardMarkup(buttons))
 
     except Exception as e:
+        logger.error("Error fetching formats: %s", e)
         await update.message.reply_text(f"Error: {str(e)}")
 
 # Function to handle download and upload inline button press
 async def download_and_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle download and upload inline button press"""
-    await update.callback_query.answer()
+    query = update.callback_query
+    await query.answer()
 
-    # Extract the YouTube URL from the callback data (you can add additional data as needed)
-    url = update.callback_query.data
-    await handle_url(update, context)
+    # The callback data carries the key of the pending URL and the chosen format
+    key, format_id = query.data.split("|", 1)
+    url = _PENDING_CHOICES.pop(key, None)
+    if url is None:
+        await query.edit_message_text("This link has expired, please send it again.")
+        return
 
-# Flask route for handling updates
-@app.route('/' + BOT_API_KEY, methods=['POST'])
-async def webhook():
-    """Handle incoming updates from Telegram"""
-    json_str = await request.get_data(as_text=True)
-    update = Update.de_json(json_str, bot_app.bot)
-    await bot_app.process_update(update)
-    return 'OK'
+    # Run the download in the background so the callback is answered right away
+    context.application.create_task(download_job(query.message, url, format_id), update=update)
+    await query.edit_message_text(f"Queued as job {key}, your video will be sent when it is ready.")
 
 def main():
-    """Main function to start the Flask app and the Telegram bot"""
-    
+    """Main function to start the Telegram bot webhook server"""
+    if not BOT_API_KEY or not WEBHOOK_URL:
+        raise SystemExit("The BOT_API_KEY and WEBHOOK_URL environment variables must be set")
+
+    bot_app = build_application()
+
     # Add handlers for commands and messages
     bot_app.add_handler(CommandHandler("start", start))
     bot_app.add_handler(CommandHandler("help", help_command))
     bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_url))
     bot_app.add_handler(CallbackQueryHandler(download_and_upload))
 
-    # Configure the ASGI server (Hypercorn)
-    config = Config()
-    config.bind = ["0.0.0.0:8080"]
-
-    # Run the ASGI server with Hypercorn, wrapped in asyncio
-    asyncio.run(serve(app, config))
+    # Serve the webhook with python-telegram-bot's built-in server
+    bot_app.run_webhook(
+        listen="0.0.0.0",
+        port=PORT,
+        url_path=BOT_API_KEY,
+        webhook_url=f"{WEBHOOK_URL}/{BOT_API_KEY}",
+        max_connections=100,
+    )
 
 if __name__ == "__main__":
     main()